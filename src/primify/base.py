@@ -1,10 +1,17 @@
+from contextlib import suppress
 from dataclasses import dataclass
+from hashlib import blake2b
+from io import BytesIO
 import math
 import multiprocessing as mp
+import os
 from pathlib import Path
-from typing import List, Literal, Union
+import tempfile
+from typing import List, Literal, Optional, Union
 import logging
-from PIL import Image, ImageFilter, ImageOps
+import numpy as np
+from gmpy2 import is_strong_bpsw_prp, mpz
+from PIL import Image, ImageFilter
 
 from primify.prime_finder import NextPrimeFinder
 from primify import console
@@ -13,8 +20,18 @@ logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
 GLYPH_ASPECT_RATIO = 0.45
+# ordered from the brightest to the darkest looking digit when printed black on white
 BRIGHTNESS_ORDERED_DIGITS: List[int] = [1, 7, 3, 9, 8]
 
+# equal width brightness bins, one per digit.
+# Descending so that level 0 is the brightest
+_LEVEL_THRESHOLDS = np.linspace(256, 0, len(BRIGHTNESS_ORDERED_DIGITS) + 1)[1:-1]
+
+# maps a quantized level onto the ASCII code of its digit
+_DIGIT_LUT = np.array(
+    [ord(str(digit)) for digit in BRIGHTNESS_ORDERED_DIGITS], dtype=np.uint8
+)
+
 
 @dataclass
 class ImageNumber:
@@ -32,16 +49,13 @@ class ImageNumber:
         Returns:
             str: the formated number as a string (has linebreaks)
         """
-        result = ""
-        for index, digit in enumerate(str(self.value)):
-
-            # take a line break after we reach the width
-            if index % self.image_width == 0 and index > 0:
-                result += "\n"
+        digits = mpz(self.value).digits()
+        width = self.image_width
 
-            result += digit
-
-        return result
+        # take a line break after we reach the width
+        return "\n".join(
+            digits[start : start + width] for start in range(0, len(digits), width)
+        )
 
 
 class PrimeImage:
@@ -49,7 +63,7 @@ class PrimeImage:
     This class provides methods to convert any image into a prime number.
 
     We use the python package Pillow to do all the image processing
-    and sympy to check for primality.
+    and gmpy2 to check for primality.
 
 
     Arguments:
@@ -88,22 +102,30 @@ class PrimeImage:
         if not (isinstance(self.max_digits, int) or (self.max_digits < 10)):
             raise ValueError("max_digits should be an integer and > 10")
 
-        # loading the Pillow image object
-        self.im = Image.open(self.image_path)
+        # eagerly loading the Pillow image object from memory, so that no file
+        # handle stays open
+        self.im = Image.open(BytesIO(self.image_path.read_bytes()))
+        self.im.load()
 
         # saving output file path
         self.output_file_path = Path(output_file_path)
 
+        # filled in by the first _image_to_number call
+        self._image_number: Optional[ImageNumber] = None
+
     @staticmethod
-    def resize_for_pixel_limit(image: Image.Image, max_pixels: int) -> Image.Image:
+    def resize_for_pixel_limit(
+        image: Image.Image, max_pixels: int, resample: int = Image.BILINEAR
+    ) -> Image.Image:
         """
         We resize the image to contain at most max_pixels pixels
 
         description:
-            The reason is that we don't want to find too large primes
+            The reason is that we don't want to find too large primes.
+            Pass resample=Image.NEAREST when resizing an already quantized image,
+            interpolating would create values between its levels.
         """
 
-        image = image.copy()
         x, y = image.size
 
         # we need to squash y since a number is usually higher than it is wide
@@ -113,75 +135,184 @@ class PrimeImage:
         scale_factor = (x * y / max_pixels) ** 0.5
         x_scaled, y_scaled = int(x / scale_factor), int(y / scale_factor)
 
-        image = image.resize((x_scaled, y_scaled))
+        # a reducing_gap lets Pillow shrink by an integer factor with its cheap box
+        # reduce() first and only resample the remaining factor
+        image = image.resize((x_scaled, y_scaled), resample=resample, reducing_gap=3.0)
         console.log(f"Resized image to be {image.size[0]} x {image.size[1]} pixels.")
 
         return image
 
     @staticmethod
     def quantize_image(image: Image.Image) -> Image.Image:
+        """
+        Quantizes the image into as many brightness levels as we have digits
 
-        n_levels = len(BRIGHTNESS_ORDERED_DIGITS)
-
-        # smooth the image to have better regions of constancy after quanitsation
-        image = image.filter(ImageFilter.MinFilter)
+        description:
+            Level 0 is the brightest, matching the order of BRIGHTNESS_ORDERED_DIGITS.
+            After Pillow's greyscale conversion all steps run as NumPy passes
+            over a single buffer. Smoothing happens before resizing, see
+            _image_to_number.
+        """
 
-        # now convert to greyscale
-        grey_scale_image = image.convert("L")
+        # Pillow's greyscale conversion is a single integer pass in C. Widen to
+        # uint16 so the contrast stretch below cannot overflow
+        grey = np.asarray(image.convert("L"), dtype=np.uint16)
 
-        # make sure we use the entire digit pallet
-        grey_scale_image = ImageOps.autocontrast(grey_scale_image)
+        # make sure we use the entire digit pallet. A flat image has no contrast to
+        # stretch and keeps its brightness
+        low, high = int(grey.min()), int(grey.max())
+        if high > low:
+            grey = (grey - low) * 255 // (high - low)
 
-        quantized_image = grey_scale_image.quantize(n_levels)
+        # fixed brightness bins instead of a palette search
+        levels = np.digitize(grey, _LEVEL_THRESHOLDS).astype(np.uint8)
         console.log("Preprocessed image for conversion into a number.")
 
-        return quantized_image
+        return Image.fromarray(levels)
 
     @staticmethod
     def quantized_image_to_number(image: Image.Image) -> ImageNumber:
         # use quantized levels as lookup indexes into BRIGHTNESS_ORDERED_DIGITS
-        digits = ""
-        for brightness_index in image.getdata():
-            digits += f"{BRIGHTNESS_ORDERED_DIGITS[brightness_index]}"
-
-        return ImageNumber(value=int(digits), image_width=image.width)
+        levels = np.frombuffer(image.tobytes(), dtype=np.uint8)
+        digits = _DIGIT_LUT[levels].tobytes()
 
-    def get_prime(self) -> ImageNumber:
+        # parse the ASCII buffer with GMP directly: subquadratic, not bound by
+        # int_max_str_digits and without an intermediate str copy
+        return ImageNumber(value=int(mpz(digits)), image_width=image.width)
 
-        with console.status(f"Converting {self.image_path} into number."):
-            quantized_image = PrimeImage.quantize_image(self.im)
+    def _image_to_number(self) -> ImageNumber:
+        """
+        Runs the whole image to number pipeline
 
-            # first we resize the image to only contain at most as many pixels as we want digits in the prime
+        description:
+            The result only depends on the image and max_digits, so it is computed
+            once and reused by repeated get_prime calls.
+        """
+        if self._image_number is None:
+            # smooth the image to have better regions of constancy after quanitsation.
+            # This has to happen at full resolution, on the resized image a 3x3
+            # minimum would erase every bright feature narrower than 3 digits
+            smoothed_image = self.im.convert("L").filter(ImageFilter.MinFilter)
+
+            # then we resize the image to only contain at most as many pixels as we want digits in the prime.
+            # Doing this before quantizing means the remaining steps only run on the small image
             resized_image = PrimeImage.resize_for_pixel_limit(
-                quantized_image, self.max_digits
+                smoothed_image, self.max_digits
             )
 
+            quantized_image = PrimeImage.quantize_image(resized_image)
+
             # now we read the image as a number
-            image_number = PrimeImage.quantized_image_to_number(resized_image)
+            self._image_number = PrimeImage.quantized_image_to_number(quantized_image)
 
-            console.log(
-                f"Converted image into a number with {int(math.log10(image_number.value))} digits."
-            )
+        return self._image_number
+
+    @staticmethod
+    def _cache_path(image_number: ImageNumber) -> Path:
+        """
+        Location of the cached prime for image_number
 
-        with console.status("Searching for a similar looking prime."):
+        description:
+            The cache lives in the user's own cache directory ($XDG_CACHE_HOME or
+            ~/.cache). It is keyed on the image number itself rather than on the
+            source image, so a hit is the next prime of exactly this number no
+            matter how the image was turned into it.
+        """
+        cache_dir = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+        key = blake2b(mpz(image_number.value).digits().encode("ascii"), digest_size=16)
+        key.update(str(image_number.image_width).encode("ascii"))
+        return cache_dir / "primify" / f"{key.hexdigest()}.txt"
+
+    @staticmethod
+    def _load_cached_prime(image_number: ImageNumber) -> Optional[int]:
+        """
+        Reads the cached prime for image_number, if there is a valid one
+
+        description:
+            The file is only trusted if it holds a prime that is at least the image
+            number and has the same amount of digits. Anything else (a truncated,
+            half written or planted file) is ignored and the search runs again.
+        """
+        try:
+            prime = mpz(PrimeImage._cache_path(image_number).read_bytes().strip())
+        except (OSError, ValueError):
+            return None
+
+        image_digits = mpz(image_number.value).digits()
+        if (
+            prime >= image_number.value
+            and len(prime.digits()) == len(image_digits)
+            and is_strong_bpsw_prp(prime)
+        ):
+            return int(prime)
 
-            # initiate helping prime finder. Much faster than just using nextprime()
-            n_processes = max(
-                1, mp.cpu_count() - 1
-            )  # at least one core should remain free
+        return None
+
+    @staticmethod
+    def _save_cached_prime(image_number: ImageNumber, prime: int) -> None:
+        """
+        Writes the next prime of image_number to the cache
+
+        description:
+            The file is written next to its final location and then moved into
+            place, so other runs never see a partial file. Failing to write the
+            cache is logged but never stops get_prime.
+        """
+        cache_path = PrimeImage._cache_path(image_number)
+        temp_path = None
+        try:
+            cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=cache_path.parent, suffix=".tmp", delete=False
+            ) as cache_file:
+                temp_path = Path(cache_file.name)
+                cache_file.write(mpz(prime).digits())
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            logger.warning("Could not cache the prime in %s: %s", cache_path, error)
+
+            # don't leave a partial file behind
+            if temp_path is not None:
+                with suppress(OSError):
+                    temp_path.unlink()
+
+    def get_prime(self) -> ImageNumber:
+
+        with console.status(f"Converting {self.image_path} into number."):
+            image_number = self._image_to_number()
 
             console.log(
-                f"Initializing multi-process prime finder with {n_processes} workers."
-            )
-            prime_finder = NextPrimeFinder(
-                value=image_number.value, n_workers=n_processes
+                f"Converted image into a number with {int(math.log10(image_number.value))} digits."
             )
-            next_prime = prime_finder.find_next_prime()
 
-            # turn result back into a formated number
-            result = ImageNumber(next_prime, image_number.image_width)
-
-            console.print(str(result), style="black on white")
-            self.output_file_path.write_text(str(result))
-            console.log(f"Saved prime to {self.output_file_path}!")
-            return result
+        next_prime = PrimeImage._load_cached_prime(image_number)
+        if next_prime is not None:
+            cache_path = PrimeImage._cache_path(image_number)
+            console.log(f"Loaded previously found prime from {cache_path}.")
+        else:
+            with console.status("Searching for a similar looking prime."):
+
+                # initiate helping prime finder. Much faster than just using nextprime()
+                n_processes = max(
+                    1, mp.cpu_count() - 1
+                )  # at least one core should remain free
+
+                console.log(
+                    f"Initializing multi-process prime finder with {n_processes} workers."
+                )
+                prime_finder = NextPrimeFinder(
+                    value=image_number.value, n_workers=n_processes
+                )
+                next_prime = prime_finder.find_next_prime()
+
+            PrimeImage._save_cached_prime(image_number, next_prime)
+
+        # turn result back into a formated number
+        result = ImageNumber(next_prime, image_number.image_width)
+
+        # format once, the same text goes to the console and the output file
+        text = str(result)
+        console.print(text, style="black on white")
+        self.output_file_path.write_bytes(text.encode("ascii"))
+        console.log(f"Saved prime to {self.output_file_path}!")
+        return result
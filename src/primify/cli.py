@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import logging
 import sys
 from pathlib import Path
 
@@ -11,6 +12,8 @@ __author__ = "Levi Borodenko"
 __copyright__ = "Levi Borodenko"
 __license__ = "mit"
 
+LOG_FORMAT = "%(message)s"
+
 
 def parse_args(args):
     """Parse command line parameters
@@ -56,6 +59,14 @@ def parse_args(args):
         dest="output_file",
     )
 
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+        help="Write debug logs to logs.txt",
+        dest="verbose",
+    )
+
     return parser.parse_args(args)
 
 
@@ -67,6 +78,11 @@ def main(args):
     """
     args = parse_args(args)
 
+    if args.verbose:
+        logging.basicConfig(
+            level=logging.DEBUG, format=LOG_FORMAT, datefmt="[%X]", filename="logs.txt"
+        )
+
     a = PrimeImage(
         image_path=args.image_path,
         max_digits=args.max_digits,
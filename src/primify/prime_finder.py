@@ -1,70 +1,148 @@
-from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import count, islice
+import ctypes
 import math
 import time
-from typing import Iterator, List, Optional, Set
+from typing import Iterator, List, Optional
 import multiprocessing as mp
-from sympy import isprime
+import numpy as np
+from gmpy2 import mpz, is_strong_bpsw_prp, next_prime
+from sympy import primerange
 import logging
 from primify import console
 
 logger = logging.getLogger(__file__)
 
+# candidates divisible by any prime below this limit are skipped before the
+# expensive primality test
+SIEVE_PRIME_LIMIT = 1000
+
+# how many primality tests worth of consecutive numbers are sieved at once
+SIEVE_WINDOW_FACTOR = 6
+
+# below this many bits a single primality test is too cheap to be worth a process pool
+SMALL_VALUE_BITS = 64
+
+# where the search starts and the offset of the smallest prime found so far
+# (-1 while there is none). Set by the pool initializer in each worker process
+_search_start = None
+_found_offset = None
+
+
+def _init_worker(search_start: mpz, found_offset) -> None:
+    global _search_start, _found_offset
+    _search_start = search_start
+    _found_offset = found_offset
+
 
 class NextPrimeFinder:
     def __init__(self, value: int, n_workers: int = 1):
-        self.value = int(value)
+        self.value = mpz(value)
         self.n_workers = n_workers
         self.expected_n_primality_tests = max(10, int(math.log(value)))
 
-    def prime_candidates(self) -> Iterator[int]:
-        candidate = self.value
+        # only primes below value are used so we never sieve out a small prime itself
+        self.sieve_primes = list(primerange(2, min(SIEVE_PRIME_LIMIT, int(self.value))))
+        self.sieve_window = SIEVE_WINDOW_FACTOR * self.expected_n_primality_tests
+
+    def prime_candidates(self) -> Iterator[mpz]:
+        window_start = self.value
+        offsets = np.arange(self.sieve_window, dtype=np.int64)
+
+        # residues of the window start. The bignum is only reduced once, moving to
+        # the next window is small int arithmetic
+        primes = np.array(self.sieve_primes, dtype=np.int64)
+        residues = np.array(
+            [int(window_start % prime) for prime in self.sieve_primes], dtype=np.int64
+        )
+
         while True:
-            if candidate % 6 in [1, 5]:
-                yield candidate
-            candidate += 1
+            # sieve a whole window of offsets at once
+            survivors = np.ones(self.sieve_window, dtype=bool)
+            for prime, residue in zip(self.sieve_primes, residues.tolist()):
+                survivors &= (residue + offsets) % prime != 0
+
+            for offset in np.flatnonzero(survivors):
+                yield window_start + int(offset)
+
+            window_start += self.sieve_window
+            residues = (residues + self.sieve_window) % primes
 
     @staticmethod
-    def is_prime_worker(candidate: int, found_prime) -> Optional[int]:
-        if not found_prime.is_set():
-            if isprime(candidate):
-                logger.info(f"{candidate} is prime!")
-                found_prime.set()
-                return candidate
-
-        logger.debug(
-            f"Checking of {candidate} skipped since we already found the next prime"
-        )
+    def is_prime_worker(candidate: mpz) -> Optional[mpz]:
+        offset = int(candidate - _search_start)
+
+        # only candidates below an already found prime can still be the next prime.
+        # Read without the lock, a stale value only means one test too many
+        found_offset = _found_offset.get_obj().value
+        if found_offset >= 0 and offset > found_offset:
+            # lazy formatting, turning a bignum into a decimal string is not free
+            logger.debug(
+                "Checking of %s skipped since we already found a smaller prime",
+                candidate,
+            )
+            return
+
+        # GMP's Baillie-PSW test, no known counterexamples
+        if is_strong_bpsw_prp(candidate):
+            logger.info("%s is prime!", candidate)
+            with _found_offset.get_lock():
+                if _found_offset.value < 0 or offset < _found_offset.value:
+                    _found_offset.value = offset
+            return candidate
+
         return
 
     def find_next_prime(self) -> int:
 
-        with mp.Pool(self.n_workers) as pool:
-            manager = mp.Manager()
-            found_prime = manager.Event()
-            candidate_iter = (
-                (candidate, found_prime) for candidate in self.prime_candidates()
-            )
-
-            results: Set[Optional[int]] = set()
-            search_start = time.time()
-            while not found_prime.is_set():
-                console.log(
-                    f"Performing batch of ~{self.expected_n_primality_tests} primality tests. We rarely need more than one batch.",
-                )
-                result = pool.starmap(
-                    NextPrimeFinder.is_prime_worker,
-                    islice(candidate_iter, self.expected_n_primality_tests),
-                )
+        if self.n_workers == 1 or self.value.bit_length() < SMALL_VALUE_BITS:
+            # without parallelism (or when tests are too cheap to be worth it) GMP's
+            # mpz_nextprime runs the whole search loop natively
+            return int(next_prime(self.value - 1))
 
-                results |= set(result)
+        # the offset lives in shared memory inherited by the workers when they start.
+        # Workers read it through get_obj() without the lock, only updates take it
+        found_offset = mp.Value(ctypes.c_longlong, -1)
+        with ProcessPoolExecutor(
+            self.n_workers,
+            initializer=_init_worker,
+            initargs=(self.value, found_offset),
+        ) as executor:
+            candidates = self.prime_candidates()
 
             console.log(
-                f"Got one! Next prime was found within {int(time.time()- search_start) + 1}s"
+                f"Performing batches of ~{self.expected_n_primality_tests} primality tests. We rarely need more than one batch.",
             )
-            pool.terminate()
+            search_start = time.time()
+            for n_batch in count(1):
+                # only report when we actually need more than one batch
+                if n_batch > 1:
+                    console.log(f"Performing batch number {n_batch}.")
+
+                batch = islice(candidates, self.expected_n_primality_tests)
+                futures = {
+                    executor.submit(NextPrimeFinder.is_prime_worker, c): c
+                    for c in batch
+                }
+
+                primes: List[mpz] = []
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+
+                    # all but the primes are None
+                    result = future.result()
+                    if result is not None:
+                        primes.append(result)
+
+                        # candidates above this prime never have to be tested but the
+                        # ones below it still need to finish, they might be prime too
+                        for pending, candidate in futures.items():
+                            if candidate > result:
+                                pending.cancel()
 
-            for result in results:
-                # all but the prime are None
-                if result is not None:
-                    return result
-        return -1
+                if primes:
+                    console.log(
+                        f"Got one! Next prime was found within {int(time.time()- search_start) + 1}s"
+                    )
+                    return int(min(primes))
@@ -1,7 +1,10 @@
+import numpy as np
+import pytest
 from PIL import Image
-from sympy import isprime
+from sympy import isprime, nextprime
 
-from primify.base import PrimeImage
+import primify.base
+from primify.base import BRIGHTNESS_ORDERED_DIGITS, ImageNumber, PrimeImage
 from primify.prime_finder import NextPrimeFinder
 
 
@@ -11,6 +14,25 @@ def test_prime_finder():
     assert isprime(instance.find_next_prime())
 
 
+def test_prime_finder_returns_next_prime():
+    value = 10 ** 40
+    instance = NextPrimeFinder(value, n_workers=4)
+    assert instance.find_next_prime() == nextprime(value - 1)
+
+
+def test_prime_finder_small_value():
+    assert NextPrimeFinder(2 ** 31 - 2, n_workers=2).find_next_prime() == 2 ** 31 - 1
+    assert NextPrimeFinder(2 ** 31 - 1, n_workers=2).find_next_prime() == 2 ** 31 - 1
+
+
+def test_image_number_formatting():
+    # more digits than python's default int_max_str_digits allows
+    number = ImageNumber(value=10 ** 9999, image_width=100)
+    rows = str(number).split("\n")
+    assert len(rows) == 100
+    assert all(len(row) == 100 for row in rows)
+
+
 def test_resize_with_pixel_limit(test_image: Image.Image, test_max_digits: int):
     resized_image = PrimeImage.resize_for_pixel_limit(test_image, test_max_digits)
     assert (
@@ -18,3 +40,103 @@ def test_resize_with_pixel_limit(test_image: Image.Image, test_max_digits: int):
         <= resized_image.width * resized_image.height
         <= test_max_digits
     )
+
+
+def test_quantize_image(test_image: Image.Image):
+    quantized_image = PrimeImage.quantize_image(test_image)
+    levels = set(quantized_image.getdata())
+    assert quantized_image.size == test_image.size
+    assert levels <= set(range(len(BRIGHTNESS_ORDERED_DIGITS)))
+
+
+def test_quantize_image_orders_levels_by_brightness():
+    # left half black, right half white
+    pixels = np.zeros((10, 20, 3), dtype=np.uint8)
+    pixels[:, 10:] = 255
+    quantized_image = PrimeImage.quantize_image(Image.fromarray(pixels))
+    levels = np.asarray(quantized_image)
+    assert levels[0, 0] == len(BRIGHTNESS_ORDERED_DIGITS) - 1
+    assert levels[0, -1] == 0
+
+    # the brightest level is written with the brightest looking digit
+    digits = str(PrimeImage.quantized_image_to_number(quantized_image).value)
+    assert digits[0] == str(BRIGHTNESS_ORDERED_DIGITS[-1])
+    assert digits[19] == str(BRIGHTNESS_ORDERED_DIGITS[0])
+
+
+@pytest.mark.parametrize("brightness, level", [(255, 0), (128, 2), (0, 4)])
+def test_quantize_flat_image(brightness: int, level: int):
+    flat_image = Image.new("RGB", (40, 40), (brightness,) * 3)
+    quantized_image = PrimeImage.quantize_image(flat_image)
+    assert set(quantized_image.getdata()) == {level}
+
+
+def test_quantized_image_to_number():
+    levels = np.arange(len(BRIGHTNESS_ORDERED_DIGITS), dtype=np.uint8)
+    quantized_image = Image.fromarray(np.stack([levels, levels[::-1]]))
+    image_number = PrimeImage.quantized_image_to_number(quantized_image)
+    digits = "".join(map(str, BRIGHTNESS_ORDERED_DIGITS))
+    assert image_number.value == int(digits + digits[::-1])
+    assert image_number.image_width == len(BRIGHTNESS_ORDERED_DIGITS)
+
+
+def test_image_to_number_is_memoized(monkeypatch):
+    prime_image = PrimeImage("tests/gauss.png", max_digits=100)
+    image_number = prime_image._image_to_number()
+
+    def rerun_pipeline(image):
+        raise AssertionError("the image was converted again")
+
+    monkeypatch.setattr(PrimeImage, "quantize_image", staticmethod(rerun_pipeline))
+    assert prime_image._image_to_number() is image_number
+
+
+def test_get_prime_uses_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    output_file = tmp_path / "prime.txt"
+    first = PrimeImage("tests/gauss.png", 100, output_file).get_prime()
+
+    def search_again(*args, **kwargs):
+        raise AssertionError("the prime was searched for again")
+
+    monkeypatch.setattr(primify.base, "NextPrimeFinder", search_again)
+    second = PrimeImage("tests/gauss.png", 100, output_file).get_prime()
+    assert second == first
+    assert output_file.read_text() == str(first)
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    [
+        # composite with the right amount of digits, as left by a planted file
+        lambda value: str(value + value % 2),
+        # truncated or half written file
+        lambda value: str(value)[:10],
+        lambda value: "",
+    ],
+)
+def test_get_prime_ignores_corrupted_cache(monkeypatch, tmp_path, corrupt):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    prime_image = PrimeImage("tests/gauss.png", 100, tmp_path / "prime.txt")
+    image_number = prime_image._image_to_number()
+
+    cache_path = PrimeImage._cache_path(image_number)
+    cache_path.parent.mkdir(parents=True)
+    cache_path.write_text(corrupt(image_number.value))
+
+    result = prime_image.get_prime()
+    assert isprime(result.value)
+    assert result.value >= image_number.value
+    assert cache_path.read_text() == str(result.value)
+
+
+def test_cached_prime_of_another_number_is_not_used(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    prime_image = PrimeImage("tests/gauss.png", 100, tmp_path / "prime.txt")
+    image_number = prime_image._image_to_number()
+
+    # a valid prime with the same amount of digits, but for a different number
+    other_number = ImageNumber(image_number.value + 10 ** 60, image_number.image_width)
+    PrimeImage._save_cached_prime(other_number, nextprime(other_number.value))
+
+    assert PrimeImage._load_cached_prime(image_number) is None